@@ -1,11 +1,242 @@
 import os
 import argparse
-import glob
+import contextlib
+import logging
+import multiprocessing
+import shlex
+import subprocess
 import sys
 import re
+import tempfile
+import time
+from threadpoolctl import threadpool_limits
 from extract_timeseries import extract_timeseries
 
-def batch_process(data_dir, atlas_path, output_dir=None, mask_path=None, exclude_runs=None, exclude_subjects=None):
+logger = logging.getLogger(__name__)
+
+# Directories that never contain cleaned timeseries but can hold huge numbers of files
+# (e.g. FreeSurfer derivatives). They are skipped entirely during the search.
+DEFAULT_PRUNE_DIRS = ("freesurfer", "node_modules")
+
+def _iter_suffix(root, suffix, prune=DEFAULT_PRUNE_DIRS, exclude=None, max_depth=None,
+                 _key=None, _ancestors=frozenset()):
+    """
+    Recursively yields (path, sibling_names) for all files under root whose name ends with suffix,
+    where sibling_names is the set of all entry names in the file's folder.
+    
+    Uses os.scandir so the file type comes from the directory listing itself,
+    without an extra stat() per entry. Hidden entries are skipped, as with glob.
+    Symlinked directories are followed like glob does; only those cost a stat(), which
+    is also used to stop at links pointing back to one of their own parent folders.
+    
+    Parameters:
+    - root: Directory to search.
+    - suffix: Filename suffix to match.
+    - prune: (Optional) Directory names to skip, or a callable taking an os.DirEntry
+      and returning True for directories that should not be descended into.
+    - exclude: (Optional) Callable taking an os.DirEntry. Directories for which it returns
+      True are not descended into, and matching files for which it returns True are not yielded.
+    - max_depth: (Optional) How many folder levels below root to search. 0 only lists root itself.
+    """
+    if _key is None:
+        try:
+            st = os.stat(root)
+        except OSError:
+            return
+        _key = (st.st_dev, st.st_ino)
+    if _key in _ancestors:
+        # Symlink loop, e.g. a link to a parent folder
+        logger.debug(f"  Not following symlink loop: {root}")
+        return
+    _ancestors = _ancestors | {_key}
+    
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except OSError:
+        # Unreadable directories are skipped silently, like glob does
+        return
+    
+    # Built on the first match only; lets callers check for neighbouring files without a stat()
+    names = None
+    
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            if max_depth is not None and max_depth <= 0:
+                continue
+            if callable(prune):
+                if prune(entry):
+                    continue
+            elif prune and entry.name in prune:
+                continue
+            if exclude and exclude(entry):
+                continue
+            if entry.is_symlink():
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                key = (st.st_dev, st.st_ino)
+            else:
+                # Plain subfolders share their parent's device; the inode comes with the listing
+                key = (_key[0], entry.inode())
+            yield from _iter_suffix(entry.path, suffix, prune, exclude,
+                                    None if max_depth is None else max_depth - 1,
+                                    key, _ancestors)
+        elif entry.name.endswith(suffix):
+            if exclude and exclude(entry):
+                continue
+            if names is None:
+                names = frozenset(e.name for e in entries)
+            yield entry.path, names
+
+def _exclusion_regex(ids):
+    """
+    Compiles a list of identifiers (e.g. ['run-01', 'sub-05']) into a single pattern
+    matching any of them, or returns None if the list is empty.
+    """
+    if not ids:
+        return None
+    # Use word boundary pattern to avoid matching 'run-1' with 'run-10'
+    # This looks for the identifier followed by a non-alphanumeric character or end of string
+    return re.compile("(?:" + "|".join(re.escape(i) for i in ids) + r")(?:[^a-zA-Z0-9]|$)")
+
+def _csv_name(filename):
+    """
+    Returns the output CSV name for an input NIfTI file name,
+    e.g. 'sub-01_cleaned.nii.gz' -> 'sub-01_cleaned_timeseries.csv'.
+    """
+    # Strip the extension by slicing rather than searching the whole name
+    if filename.endswith(".nii.gz"):
+        stem = filename[:-7]
+    elif filename.endswith(".nii"):
+        stem = filename[:-4]
+    else:
+        stem = filename
+    return f"{stem}_timeseries.csv"
+
+def _init_worker(log_level):
+    """
+    Limits each worker process to a single BLAS/OpenMP thread, so that running
+    several extractions in parallel does not oversubscribe the CPU.
+    Also sets up logging for workers that were spawned rather than forked.
+    """
+    # The thread pools are already loaded by the time the worker starts, so
+    # environment variables would have no effect; limit them at runtime instead.
+    # The limit lasts for the life of the worker process.
+    global _thread_limit
+    _thread_limit = threadpool_limits(limits=1)
+    logging.basicConfig(level=log_level, format="%(message)s", stream=sys.stdout)
+
+def _worker(task):
+    """
+    Runs one extraction and returns (input_path, error), where error is None on success.
+    Defined at module level so it can be sent to a multiprocessing.Pool.
+    """
+    input_path, atlas_path, output_path, mask_path = task
+    try:
+        extract_timeseries(input_path, atlas_path, output_path, mask_path)
+        return input_path, None
+    except SystemExit:
+        # extract_timeseries logs the cause and calls sys.exit(1); report it instead of losing the worker
+        return input_path, "extraction failed (see log above)"
+    except Exception as e:
+        return input_path, str(e) or type(e).__name__
+
+# SLURM rejects arrays with indices above MaxArraySize - 1 (1001 by default), so larger
+# task lists are split into several array jobs of at most this many tasks each.
+MAX_ARRAY_SIZE = 1000
+
+# Job-array script used by --sbatch. Each array task reads its line of the task list
+# (input path <TAB> output path) and runs extract_timeseries.py on it.
+SBATCH_TEMPLATE = """#!/bin/bash
+#SBATCH --job-name=extract_timeseries
+#SBATCH --array=1-{n_tasks}%20
+#SBATCH --cpus-per-task=4
+#SBATCH --mem=16G
+#SBATCH --output={log_pattern}
+
+LINE=$(sed -n "$((SLURM_ARRAY_TASK_ID + {offset}))p" {tasks_file})
+INPUT=$(printf '%s\\n' "$LINE" | cut -f1)
+OUTPUT=$(printf '%s\\n' "$LINE" | cut -f2)
+
+# Checked here rather than when submitting, so array tasks never race on it
+if [ -e "$OUTPUT" ]; then
+    echo "Output $OUTPUT already exists. Skipping."
+    exit 0
+fi
+
+{python} {script} "$INPUT" {atlas} "$OUTPUT"{mask_arg}
+"""
+
+def submit_sbatch(tasks, sbatch_dir):
+    """
+    Writes a SLURM job-array script with one array task per extraction and submits it with sbatch.
+    Task lists longer than MAX_ARRAY_SIZE are split into several array jobs.
+    
+    Parameters:
+    - tasks: List of (input_path, atlas_path, output_path, mask_path) tuples.
+    - sbatch_dir: Directory in which to write the task list, the script and the job logs.
+    """
+    log_dir = os.path.join(sbatch_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    
+    # Array tasks read their line of the task list only when they start, so every submission
+    # gets its own folder; a later --sbatch run must not rewrite the list under queued tasks.
+    submit_dir = tempfile.mkdtemp(dir=sbatch_dir, prefix=time.strftime("submit_%Y%m%d-%H%M%S_"))
+    
+    tasks_file = os.path.abspath(os.path.join(submit_dir, "subjects.txt"))
+    with open(tasks_file, "w") as f:
+        for input_path, _, output_path, _ in tasks:
+            f.write(f"{os.path.abspath(input_path)}\t{os.path.abspath(output_path)}\n")
+    
+    # All tasks share the same atlas and mask
+    _, atlas_path, _, mask_path = tasks[0]
+    mask_arg = f" --mask {shlex.quote(os.path.abspath(mask_path))}" if mask_path else ""
+    
+    # One array job per MAX_ARRAY_SIZE tasks; each reads its lines starting at its offset
+    offsets = range(0, len(tasks), MAX_ARRAY_SIZE)
+    script_paths = []
+    for k, offset in enumerate(offsets):
+        name = "extract_timeseries_array.sh" if len(offsets) == 1 else f"extract_timeseries_array_{k + 1}.sh"
+        script_path = os.path.join(submit_dir, name)
+        with open(script_path, "w") as f:
+            f.write(SBATCH_TEMPLATE.format(
+                n_tasks=min(MAX_ARRAY_SIZE, len(tasks) - offset),
+                offset=offset,
+                log_pattern=shlex.quote(os.path.join(os.path.abspath(log_dir), "%x_%A_%a.out")),
+                tasks_file=shlex.quote(tasks_file),
+                python=shlex.quote(sys.executable),
+                script=shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), "extract_timeseries.py")),
+                atlas=shlex.quote(os.path.abspath(atlas_path)),
+                mask_arg=mask_arg,
+            ))
+        script_paths.append(script_path)
+    
+    if len(script_paths) == 1:
+        logger.info(f"Wrote job array for {len(tasks)} files to: {script_paths[0]}")
+    else:
+        logger.info(f"Wrote {len(script_paths)} job arrays of at most {MAX_ARRAY_SIZE} tasks for {len(tasks)} files to: {submit_dir}")
+    
+    for i, script_path in enumerate(script_paths):
+        try:
+            subprocess.run(["sbatch", script_path], check=True)
+        except FileNotFoundError:
+            logger.info("sbatch not found. Submit the jobs manually with:")
+            for path in script_paths:
+                logger.info(f"  sbatch {path}")
+            return
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error: sbatch failed with exit code {e.returncode}.")
+            if i + 1 < len(script_paths):
+                logger.error("Not submitted:")
+                for path in script_paths[i + 1:]:
+                    logger.error(f"  sbatch {path}")
+            return
+
+def batch_process(data_dir, atlas_path, output_dir=None, mask_path=None, exclude_runs=None, exclude_subjects=None, prune_dirs=DEFAULT_PRUNE_DIRS, jobs=1, sbatch_dir=None, max_depth=None):
     """
     Recursively finds all 4D fMRI files matching the pattern and extracts time series.
     
@@ -16,115 +247,137 @@ def batch_process(data_dir, atlas_path, output_dir=None, mask_path=None, exclude
     - mask_path: (Optional) Path to a common binary mask file.
     - exclude_runs: (Optional) List of run identifiers to exclude.
     - exclude_subjects: (Optional) List of subject identifiers to exclude.
+    - prune_dirs: (Optional) Directory names to skip entirely while searching.
+    - jobs: (Optional) Number of files to process in parallel.
+    - sbatch_dir: (Optional) If given, submit a SLURM job array (written to this directory)
+      instead of processing the files locally.
+    - max_depth: (Optional) How many folder levels below data_dir to search. By default the whole tree is searched.
     """
     
     # The pattern based on user description:
     # conf_correction* -> confound_correction_datasink -> cleaned_timeseries -> *"sub-name"*"ses-0#"* -> "sub-name"*
-    # Since the structure is deep and variable, using a recursive glob with the filename suffix is the most robust approach.
+    # Since the structure is deep and variable, a recursive search on the filename suffix is the most robust approach.
     # We look for any file ending in 'cleaned.nii.gz' anywhere under the data_dir.
-    search_pattern = "**/*cleaned.nii.gz"
+    search_suffix = "cleaned.nii.gz"
     
-    print(f"Searching for files in: {data_dir}")
-    print(f"Pattern: {search_pattern} (recursive)")
+    logger.info(f"Searching for files in: {data_dir}")
+    logger.info(f"Suffix: *{search_suffix} (recursive)")
+    if prune_dirs:
+        logger.info(f"Skipping directories: {', '.join(prune_dirs)}")
+    if max_depth is not None:
+        logger.info(f"Searching at most {max_depth} folder level(s) deep")
     
-    # recursive=True allows ** to match subdirectories of any depth
-    files = glob.glob(os.path.join(data_dir, search_pattern), recursive=True)
+    # Build the exclusion patterns once. They are checked against each folder and file name
+    # during the search, so excluded subject folders are never descended into.
+    # Identifiers containing a path separator (e.g. 'sub-01/ses-01') span several folder
+    # levels, so they are matched against the path relative to data_dir instead.
+    def compile_ids(ids):
+        ids = [i.replace("/", os.sep).strip(os.sep) for i in ids or ()]
+        return (_exclusion_regex([i for i in ids if i and os.sep not in i]),
+                _exclusion_regex([i for i in ids if os.sep in i]))
     
-    if not files:
-        print("No files found matching the pattern!")
-        return
-
-    print(f"Found {len(files)} files to process.")
+    run_re, run_path_re = compile_ids(exclude_runs)
+    sub_re, sub_path_re = compile_ids(exclude_subjects)
+    root_prefix = os.path.join(data_dir, "")
     
-    # Filter out excluded runs and subjects
-    if exclude_runs or exclude_subjects:
-        original_count = len(files)
-        filtered_files = []
-        
-        for file_path in files:
-            # Check if file should be excluded based on run identifiers
-            if exclude_runs:
-                exclude_file = False
-                for run_id in exclude_runs:
-                    # Use word boundary pattern to avoid matching 'run-1' with 'run-10'
-                    # This looks for the run_id followed by a non-alphanumeric character or end of string
-                    pattern = re.escape(run_id) + r'(?:[^a-zA-Z0-9]|$)'
-                    if re.search(pattern, file_path):
-                        print(f"  Excluding (run): {file_path}")
-                        exclude_file = True
-                        break
-                if exclude_file:
-                    continue
-            
-            # Check if file should be excluded based on subject identifiers
-            if exclude_subjects:
-                exclude_file = False
-                for subject_id in exclude_subjects:
-                    # Use word boundary pattern to avoid matching 'sub-1' with 'sub-10'
-                    # This looks for the subject_id followed by a non-alphanumeric character or end of string
-                    pattern = re.escape(subject_id) + r'(?:[^a-zA-Z0-9]|$)'
-                    if re.search(pattern, file_path):
-                        print(f"  Excluding (subject): {file_path}")
-                        exclude_file = True
-                        break
-                if exclude_file:
-                    continue
-            
-            # If not excluded, add to filtered list
-            filtered_files.append(file_path)
-        
-        files = filtered_files
-        print(f"After filtering: {len(files)} files remaining ({original_count - len(files)} excluded).")
+    def matches(name_re, path_re, entry):
+        return bool((name_re and name_re.search(entry.name))
+                    or (path_re and path_re.search(entry.path[len(root_prefix):])))
     
-    if not files:
-        print("No files remaining after exclusion filters!")
-        return
+    excluded = []
+    
+    def is_excluded(entry):
+        if matches(run_re, run_path_re, entry):
+            logger.debug(f"  Excluding (run): {entry.path}")
+        elif matches(sub_re, sub_path_re, entry):
+            logger.debug(f"  Excluding (subject): {entry.path}")
+        else:
+            return False
+        excluded.append(entry.path)
+        return True
     
     # Create output directory if specified
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
-        print(f"Outputs will be saved to: {output_dir}")
+        logger.info(f"Outputs will be saved to: {output_dir}")
     else:
-        print("Outputs will be saved alongside input files.")
+        logger.info("Outputs will be saved alongside input files.")
 
-    success_count = 0
-    error_count = 0
-
-    for i, input_path in enumerate(files):
-        print(f"\n[{i+1}/{len(files)}] Processing: {input_path}")
-        
-        try:
-            # Determine output filename
-            filename = os.path.basename(input_path)
-            # Replace extension
-            base_name = filename.replace(".nii.gz", "").replace(".nii", "")
-            csv_name = f"{base_name}_timeseries.csv"
+    found_count = 0
+    skipped_count = 0
+    # Names already present in output_dir, listed once instead of one stat() per file
+    existing = set(os.listdir(output_dir)) if output_dir else None
+    
+    def pending_tasks():
+        # Search, filtering and output naming happen in a single streaming pass,
+        # so extraction can start before the whole tree has been searched.
+        nonlocal found_count, skipped_count
+        for input_path, sibling_names in _iter_suffix(data_dir, search_suffix, prune_dirs, is_excluded if (run_re or run_path_re or sub_re or sub_path_re) else None, max_depth):
+            found_count += 1
             
-            if output_dir:
-                output_path = os.path.join(output_dir, csv_name)
-            else:
-                # Save in the same folder as the input
-                parent_dir = os.path.dirname(input_path)
-                output_path = os.path.join(parent_dir, csv_name)
+            # Save in output_dir, or in the same folder as the input
+            parent_dir, filename = os.path.split(input_path)
+            parent_dir = output_dir or parent_dir
+            csv_name = _csv_name(filename)
+            output_path = os.path.join(parent_dir, csv_name)
             
             # Check if output already exists to avoid re-doing work (optional but nice)
-            if os.path.exists(output_path):
-                print(f"  -> Output {output_path} already exists. Skipping.")
-                continue
-
-            # Run extraction
-            extract_timeseries(input_path, atlas_path, output_path, mask_path)
-            success_count += 1
+            # For SLURM job arrays, each array task does this check itself.
+            if sbatch_dir is None:
+                # When saving next to the input, the search has already listed that folder
+                existing_names = existing if output_dir else sibling_names
+                if csv_name in existing_names:
+                    logger.info(f"  -> Output {output_path} already exists. Skipping.")
+                    skipped_count += 1
+                    continue
             
-        except Exception as e:
-            print(f"  -> ERROR processing {input_path}: {e}")
-            error_count += 1
+            yield (input_path, atlas_path, output_path, mask_path)
+    
+    if sbatch_dir is not None:
+        # The job array needs its size up front
+        tasks = list(pending_tasks())
+        if tasks:
+            submit_sbatch(tasks, sbatch_dir)
+    
+    else:
+        success_count = 0
+        error_count = 0
+        
+        jobs = max(1, jobs)
+        logger.info(f"Processing files with {jobs} parallel job(s) as they are found.")
+        
+        # Each file is independent, so they are spread over a pool of worker processes.
+        # With a single job everything runs in this process instead.
+        with (multiprocessing.Pool(processes=jobs, initializer=_init_worker, initargs=(logging.getLogger().level,)) if jobs > 1 else contextlib.nullcontext()) as pool:
+            results = pool.imap_unordered(_worker, pending_tasks()) if pool else map(_worker, pending_tasks())
             
-    print("\n" + "="*30)
-    print("Batch Processing Complete")
-    print(f"Successfully processed: {success_count}")
-    print(f"Errors: {error_count}")
-    print("="*30)
+            for i, (input_path, error) in enumerate(results):
+                if error is None:
+                    logger.info(f"\n[{i+1}] Finished: {input_path}")
+                    success_count += 1
+                else:
+                    logger.error(f"\n[{i+1}] -> ERROR processing {input_path}: {error}")
+                    error_count += 1
+    
+    if not found_count:
+        if excluded:
+            logger.info(f"No files remaining after exclusion filters! ({len(excluded)} files or folders excluded)")
+        else:
+            logger.info("No files found matching the pattern!")
+        return
+    
+    if sbatch_dir is not None:
+        return
+    
+    logger.info("\n" + "="*30)
+    logger.info("Batch Processing Complete")
+    logger.info(f"Files found: {found_count}")
+    if excluded:
+        logger.info(f"Excluded during the search: {len(excluded)} files or folders")
+    logger.info(f"Skipped (output exists): {skipped_count}")
+    logger.info(f"Successfully processed: {success_count}")
+    logger.info(f"Errors: {error_count}")
+    logger.info("="*30)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Batch extract time series from multiple fMRI files.")
@@ -135,26 +388,40 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", help="(Optional) Directory to save all output CSVs. If omitted, saves next to input files.", default=None)
     parser.add_argument("--exclude-runs", help="(Optional) Comma-separated list of run identifiers to exclude (e.g., 'run-01,run-03')", default=None)
     parser.add_argument("--exclude-subjects", help="(Optional) Comma-separated list of subject identifiers to exclude (e.g., 'sub-01,sub-05')", default=None)
+    parser.add_argument("--jobs", type=int, help="(Optional) Number of files to process in parallel. (default: half the CPU cores)", default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--sbatch", action="store_true", help="(Optional) Submit the files as a SLURM job array instead of processing them locally.")
+    parser.add_argument("--sbatch-dir", help="(Optional) Directory for the SLURM task lists, job scripts and logs; each submission gets its own subfolder. (default: 'sbatch_jobs')", default="sbatch_jobs")
+    parser.add_argument("--max-depth", type=int, help="(Optional) How many folder levels below data_dir to search (0 = only data_dir itself). By default the whole tree is searched.", default=None)
+    parser.add_argument("--verbose", action="store_true", help="(Optional) Also log every excluded file or folder.")
+    parser.add_argument("--prune-dirs", help=f"(Optional) Comma-separated list of directory names to skip while searching. Pass an empty string to search everything. (default: '{','.join(DEFAULT_PRUNE_DIRS)}')", default=None)
     
     args = parser.parse_args()
     
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s", stream=sys.stdout)
+    
     if not os.path.exists(args.data_dir):
-        print(f"Error: Data directory {args.data_dir} not found.")
+        logger.error(f"Error: Data directory {args.data_dir} not found.")
         sys.exit(1)
         
     if not os.path.exists(args.atlas_path):
-        print(f"Error: Atlas file {args.atlas_path} not found.")
+        logger.error(f"Error: Atlas file {args.atlas_path} not found.")
         sys.exit(1)
     
     # Parse exclusion lists
     exclude_runs = None
     if args.exclude_runs:
         exclude_runs = [run.strip() for run in args.exclude_runs.split(',')]
-        print(f"Excluding runs: {exclude_runs}")
+        logger.info(f"Excluding runs: {exclude_runs}")
     
     exclude_subjects = None
     if args.exclude_subjects:
         exclude_subjects = [sub.strip() for sub in args.exclude_subjects.split(',')]
-        print(f"Excluding subjects: {exclude_subjects}")
+        logger.info(f"Excluding subjects: {exclude_subjects}")
+    
+    # Parse pruned directories (None keeps the defaults)
+    prune_dirs = DEFAULT_PRUNE_DIRS
+    if args.prune_dirs is not None:
+        prune_dirs = tuple(d.strip() for d in args.prune_dirs.split(',') if d.strip())
 
-    batch_process(args.data_dir, args.atlas_path, args.output_dir, args.mask, exclude_runs, exclude_subjects)
+    batch_process(args.data_dir, args.atlas_path, args.output_dir, args.mask, exclude_runs, exclude_subjects, prune_dirs, args.jobs,
+                  args.sbatch_dir if args.sbatch else None, args.max_depth)
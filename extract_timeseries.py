@@ -1,11 +1,131 @@
 import argparse
+import functools
+import logging
 import pandas as pd
 import numpy as np
 import nibabel as nib
-from nilearn.maskers import NiftiLabelsMasker
+from nilearn.image import resample_img
+from scipy.sparse import csr_matrix
 import sys
 import os
 
+logger = logging.getLogger(__name__)
+
+# Number of time points read from the 4D file at once. Bounds memory to one block of
+# volumes instead of the whole run.
+TIME_CHUNK = 64
+
+@functools.lru_cache(maxsize=8)
+def _atlas_labels(atlas_3d, atlas_mtime):
+    """
+    Returns the sorted region labels of an atlas, without the background (0).
+    
+    Cached, so a batch sharing one atlas decodes it once per process.
+    The modification time is only part of the cache key, so that an edited atlas is picked up.
+    """
+    atlas_img = nib.load(atlas_3d)
+    # Read the labels through dataobj straight into int32, avoiding get_fdata()'s float64 copy of the whole volume
+    atlas_data = np.asarray(atlas_img.dataobj, dtype=np.int32).ravel(order="K")
+    if atlas_data.size and atlas_data.min() < 0:
+        all_labels = np.unique(atlas_data).tolist()
+    else:
+        # Labels are small non-negative integers, so counting them yields the sorted unique labels in one pass
+        all_labels = np.flatnonzero(np.bincount(atlas_data)).tolist()
+    if all_labels[0] == 0:
+        all_labels = all_labels[1:] # Remove background
+    return tuple(all_labels)
+
+def _on_grid(path, affine, shape):
+    """
+    Loads a 3D image (dropping trailing singleton dimensions) and resamples it (nearest neighbour) to the given affine and shape.
+    Images already on that grid, e.g. an atlas registered to the EPI during preprocessing,
+    are returned as loaded, skipping the resampling.
+    """
+    # Atlases and masks saved as (x, y, z, 1), as FSL tools often do, are treated as 3D
+    img = nib.funcs.squeeze_image(nib.load(path))
+    if img.shape == tuple(shape) and np.allclose(img.affine, affine, atol=1e-4):
+        return img
+    return resample_img(img, target_affine=affine, target_shape=shape, interpolation="nearest")
+
+@functools.lru_cache(maxsize=8)
+def _region_layout(atlas_3d, atlas_mtime, mask_img, mask_mtime, affine_bytes, shape, all_labels):
+    """
+    Resamples the atlas (and mask) to a data grid (nearest neighbour) and encodes it for _region_means.
+    
+    Cached, so a batch of runs sharing one grid resamples the atlas once per process.
+    The modification times are only part of the cache key, so that edited files are picked up.
+    
+    Returns (voxels, counts, indicator): the boolean map of labelled voxels on the data grid,
+    the number of voxels in each region, and a sparse (regions x labelled voxels) matrix
+    with indicator[k, v] = 1 if voxel v belongs to region k.
+    """
+    affine = np.frombuffer(affine_bytes).reshape(4, 4)
+    labels = np.asarray(_on_grid(atlas_3d, affine, shape).dataobj, dtype=np.int32)
+    if mask_img is not None:
+        labels[np.asarray(_on_grid(mask_img, affine, shape).dataobj) == 0] = 0
+    
+    # Output column of every labelled voxel; everything else is background
+    voxels = labels != 0
+    cols = np.searchsorted(all_labels, labels[voxels])
+    n_regions = len(all_labels)
+    counts = np.bincount(cols, minlength=n_regions)
+    indicator = csr_matrix((np.ones(cols.size), (cols, np.arange(cols.size))), shape=(n_regions, cols.size))
+    
+    # Shared between calls
+    voxels.flags.writeable = False
+    counts.flags.writeable = False
+    return voxels, counts, indicator
+
+def _region_means(data_img, atlas_3d, all_labels, mask_img=None):
+    """
+    Computes the mean signal of every atlas region at every time point.
+    
+    Gives the same signals as NiftiLabelsMasker(standardize=False): the atlas and mask are
+    resampled to the data grid (nearest neighbour) and non-finite values count as 0,
+    with one warning per file.
+    But instead of a per-region loop, the atlas is encoded once as a sparse
+    (regions x labelled voxels) indicator matrix, and each block of TIME_CHUNK
+    volumes is reduced with a single sparse matrix product. The 4D data is
+    read block by block rather than all at once.
+    
+    Parameters:
+    - data_img: Loaded 4D fMRI image.
+    - atlas_3d: Path to the 3D Atlas NIfTI file.
+    - all_labels: Tuple of sorted region labels (without background) defining the output columns.
+    - mask_img: (Optional) Path to a binary mask NIfTI file.
+    
+    Returns (time_series, counts): an (n_timepoints, len(all_labels)) array of region means
+    and the number of voxels found in each region. Empty regions are left at 0.
+    """
+    if len(data_img.shape) != 4:
+        raise ValueError(f"Expected a 4D image, got shape {data_img.shape}.")
+    
+    voxels, counts, indicator = _region_layout(
+        atlas_3d, os.path.getmtime(atlas_3d),
+        mask_img, os.path.getmtime(mask_img) if mask_img else None,
+        data_img.affine.astype(np.float64).tobytes(), data_img.shape[:3], all_labels)
+    n_regions = len(all_labels)
+    
+    n_timepoints = data_img.shape[3]
+    sums = np.empty((n_timepoints, n_regions))
+    non_finite = False
+    for t0 in range(0, n_timepoints, TIME_CHUNK):
+        # Slicing the proxy only reads this block of volumes from disk
+        block = np.asarray(data_img.dataobj[..., t0:t0 + TIME_CHUNK])
+        # (labelled voxels, time points in block)
+        values = block[voxels]
+        if not np.isfinite(values).all():
+            non_finite = True
+            np.nan_to_num(values, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+        sums[t0:t0 + values.shape[1]] = (indicator @ values).T
+    
+    if non_finite:
+        # Same diagnostic as NiftiLabelsMasker, once per file
+        logger.warning("WARNING: Non-finite values detected. These values will be replaced with zeros.")
+    
+    time_series = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    return time_series, counts
+
 def extract_timeseries(input_4d, atlas_3d, output_csv, mask_img=None):
     """
     Extracts time series from a 4D NIfTI file using a 3D Atlas.
@@ -17,110 +137,44 @@ def extract_timeseries(input_4d, atlas_3d, output_csv, mask_img=None):
     - mask_img: (Optional) Path to a binary mask NIfTI file.
     """
     
-    print(f"Loading Atlas: {atlas_3d}")
-    print(f"Loading 4D Data: {input_4d}")
+    logger.info(f"Loading Atlas: {atlas_3d}")
+    logger.info(f"Loading 4D Data: {input_4d}")
     if mask_img:
-        print(f"Using Mask: {mask_img}")
+        logger.info(f"Using Mask: {mask_img}")
     else:
-        print("No mask provided. Using Atlas definition directly.")
+        logger.info("No mask provided. Using Atlas definition directly.")
 
-    # Initialize the masker
-    # standardize=False: We assume input is already cleaned/preprocessed as per user description.
-    # detrend=False: We assume input is already cleaned.
-    masker = NiftiLabelsMasker(labels_img=atlas_3d, mask_img=mask_img, standardize=False)
+    # Load the Atlas manually to get the "Ground Truth" list of all regions.
+    # Every region gets a column, even if it ends up empty in the data.
+    all_labels = _atlas_labels(atlas_3d, os.path.getmtime(atlas_3d))
+    
+    logger.info(f"Total regions in Atlas file: {len(all_labels)}")
     
     # Extract signals
-    # Output shape: (n_timepoints, n_regions)
-    print("Extracting signals...")
+    # No standardization or detrending: we assume input is already cleaned/preprocessed as per user description.
+    # Output shape: (n_timepoints, n_regions), columns in Atlas order (1, 2, 3...)
+    logger.info("Extracting signals...")
     try:
-        time_series = masker.fit_transform(input_4d)
+        # keep_file_open: the time blocks are read in order, so a .nii.gz file is
+        # decompressed once instead of from the start for every block
+        time_series, counts = _region_means(nib.load(input_4d, keep_file_open=True), atlas_3d, all_labels, mask_img)
     except Exception as e:
-        print(f"Error during extraction: {e}")
+        logger.error(f"Error during extraction: {e}")
         sys.exit(1)
-        
-    # Get region labels
-    # masker.labels_ contains the labels that nilearn found in the atlas.
-    # Note: NiftiLabelsMasker drops regions that are empty (no signal in input_4d),
-    # so we need to check if any are missing and pad them.
-    extracted_labels = masker.labels_
-    print(f"Extracted signals for {time_series.shape[1]} regions.")
-    
-    # NiftiLabelsMasker includes the background label (usually 0) in .labels_ 
-    # if it's in the atlas image, even if it ignores it during extraction.
-    # We generally want to ignore 0.
-    if extracted_labels[0] == 0:
-        extracted_labels = extracted_labels[1:]
-        
-    # Double check alignment
-    if len(extracted_labels) != time_series.shape[1]:
-        # Sometimes nilearn drops regions entirely if they are empty in the data
-        print(f"Warning: Extracted {time_series.shape[1]} signals but found {len(extracted_labels)} labels.")
-        # We need to trust the data shape. The 'extracted_labels' usually matches the *Atlas* content.
-        # But if regions were dropped due to being empty, we need to find out WHICH ones.
-        pass
-
-    # To Ensure we have ALL regions from the atlas, we should inspect the atlas directly 
-    # or rely on extracted_labels being the "Truth" from the atlas file.
     
-    # 1. Create DataFrame with the labels nilearn *did* extract
-    # We assume 'extracted_labels' are the ones associated with the columns of 'time_series'
-    # IF nilearn dropped regions, 'extracted_labels' might still contain ALL atlas labels
-    # while 'time_series' is smaller.
+    # Region means are accumulated in float64 but stored as float32: it is the precision of
+    # typical fMRI data, and halves what the CSV writer has to format.
+    time_series = time_series.astype(np.float32, copy=False)
     
-    # Strategy: 
-    # If (len(extracted_labels) > time_series.shape[1]), it means nilearn kept the labels list full
-    # but dropped columns. We need to find which are missing.
-    # HOWEVER, NiftiLabelsMasker behavior varies. 
-    # The most robust way: Load the Atlas manually to get the "Ground Truth" list of all regions.
+    # Regions without any voxel on the data grid (or inside the mask) are kept as columns of zeros
+    missing = [label for label, count in zip(all_labels, counts) if count == 0]
+    logger.info(f"Extracted signals for {len(all_labels) - len(missing)} regions.")
+    if missing:
+        logger.warning(f"WARNING: Extracted {len(all_labels) - len(missing)} regions, but Atlas has {len(all_labels)}.")
+        logger.warning("Padding missing regions with Zeros...")
+        logger.warning(f"  -> Regions missing, filled with 0: {missing}")
     
-    atlas_img = nib.load(atlas_3d)
-    atlas_data = atlas_img.get_fdata()
-    all_labels = sorted(list(np.unique(atlas_data.astype(int))))
-    if all_labels[0] == 0:
-        all_labels = all_labels[1:] # Remove background
-    
-    print(f"Total regions in Atlas file: {len(all_labels)}")
-    
-    # Check if we are missing any
-    if time_series.shape[1] < len(all_labels):
-        print(f"WARNING: Extracted {time_series.shape[1]} regions, but Atlas has {len(all_labels)}.")
-        print("Padding missing regions with Zeros...")
-        
-        # We need to map the columns we HAVE to the labels we EXPECT.
-        # Unfortunately, NiftiLabelsMasker doesn't easily tell us "Column 1 is Region 5" if it silently dropped Region 2.
-        # BUT: masker.labels_ *usually* contains the list of labels that correspond to the columns... 
-        # WAIT: The documentation says "labels_: the labels of the regions extracted".
-        # So if a region is dropped, it should be missing from masker.labels_.
-        
-        # Let's verify that assumption.
-        current_labels = list(extracted_labels)
-        
-        # If lengths mismatch (labels vs columns), we have a deeper issue, but usually they match.
-        if len(current_labels) != time_series.shape[1]:
-             # Fallback: if nilearn kept the background in the list but not the data
-             if len(current_labels) == time_series.shape[1] + 1:
-                 current_labels = current_labels[1:]
-        
-        # Create the initial DF with what we have
-        df = pd.DataFrame(time_series, columns=current_labels)
-        
-        # Add missing columns
-        for label in all_labels:
-            if label not in df.columns:
-                print(f"  -> Region {label} missing. Filling with 0.")
-                df[label] = 0.0
-                
-        # Sort columns to match Atlas order (1, 2, 3...)
-        df = df.reindex(columns=all_labels)
-        
-    else:
-        # All good, just creating the DF
-        # Handle the mismatch if nilearn included background in labels list
-        current_labels = list(extracted_labels)
-        if len(current_labels) == time_series.shape[1] + 1:
-             current_labels = current_labels[1:]
-             
-        df = pd.DataFrame(time_series, columns=current_labels)
+    df = pd.DataFrame(time_series, columns=list(all_labels))
 
     
     # Add a 'TR' (Time Repetition) column for clarity? 
@@ -129,11 +183,11 @@ def extract_timeseries(input_4d, atlas_3d, output_csv, mask_img=None):
     # Current format: Index is time, Columns are regions.
     
     # Save to CSV
-    print(f"Saving to {output_csv}...")
+    logger.info(f"Saving to {output_csv}...")
     df.to_csv(output_csv, index=False) # index=False means we don't save the row numbers 0..N explicitly as a column, unless desired.
     # But usually for time series, the row order implies time.
     
-    print("Done!")
+    logger.info("Done!")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract mean time series from 4D fMRI NIfTI using an Atlas.")
@@ -145,16 +199,18 @@ if __name__ == "__main__":
     
     args = parser.parse_args()
     
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    
     if not os.path.exists(args.input_4d):
-        print(f"Error: Input file {args.input_4d} not found.")
+        logger.error(f"Error: Input file {args.input_4d} not found.")
         sys.exit(1)
         
     if not os.path.exists(args.atlas_3d):
-        print(f"Error: Atlas file {args.atlas_3d} not found.")
+        logger.error(f"Error: Atlas file {args.atlas_3d} not found.")
         sys.exit(1)
         
     if args.mask and not os.path.exists(args.mask):
-        print(f"Error: Mask file {args.mask} not found.")
+        logger.error(f"Error: Mask file {args.mask} not found.")
         sys.exit(1)
 
     extract_timeseries(args.input_4d, args.atlas_3d, args.output_csv, args.mask)